@@ -3,6 +3,8 @@
 ##  NLCrypt WebApp
 ##
 ##  usage: $ python app.py -s localhost 8080
+##         $ python app.py -s -t 8 localhost 8080      (thread pool)
+##         $ python app.py -s -p 4 -t 2 localhost 8080 (pre-forked processes)
 ##
 import sys
 import re
@@ -36,6 +38,26 @@ def mergedict(d1, d2):
     d1.update(d2)
     return d1
 
+# iterate the lines of a request body (up to its Content-Length).
+def iterbody(environ, bufsize=8192):
+    fp = environ.get('wsgi.input')
+    try:
+        n = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        n = 0
+    buf = ''
+    while 0 < n:
+        data = fp.read(min(n, bufsize))
+        if not data: break
+        n -= len(data)
+        lines = (buf+data).split('\n')
+        buf = lines.pop()
+        for line in lines:
+            yield line+'\n'
+    if buf:
+        yield buf
+    return
+
 # iterable
 def iterable(obj):
     return hasattr(obj, '__iter__')
@@ -53,8 +75,9 @@ class Template(object):
 
     def __init__(self, *args, **kwargs):
         if '_copyfrom' in kwargs:
-            _copyfrom = kwargs['_copyfrom']
+            _copyfrom = kwargs.pop('_copyfrom')
             objs = _copyfrom.objs
+            code = _copyfrom._code
             kwargs = mergedict(_copyfrom.kwargs, kwargs)
         else:
             objs = []
@@ -69,8 +92,13 @@ class Template(object):
                         objs.append(self.Variable(x[0], x[1:-1]))
                     i0 = m.end(0)
                 objs.append(line[i0:])
+            code = self._compile(objs)
         self.objs = objs
         self.kwargs = kwargs
+        self._code = code
+        # A template without variables is rendered only once per codec.
+        self._static = not any( isinstance(obj, self.Variable) for obj in code )
+        self._cache = {}
         return
 
     def __call__(self, **kwargs):
@@ -91,68 +119,93 @@ class Template(object):
         if closable(lines):
             lines.close()
         return template
-    
+
+    @classmethod
+    def _compile(klass, objs):
+        # Merge adjacent strings.
+        code = []
+        for obj in objs:
+            if isinstance(obj, klass.Variable):
+                code.append(obj)
+            elif not obj:
+                pass
+            elif code and type(code[-1]) is type(obj):
+                code[-1] += obj
+            else:
+                code.append(obj)
+        return code
+
     def render(self, codec='utf-8', **kwargs):
-        kwargs = mergedict(self.kwargs, kwargs)
-        def render1(value, quote=False):
-            if value is None:
+        out = []
+        self._render(out, codec, mergedict(self.kwargs, kwargs) if kwargs else self.kwargs)
+        return iter(out)
+
+    # tostring: returns the rendered template as a byte string.
+    def tostring(self, codec='utf-8', **kwargs):
+        if self._static and not kwargs:
+            try:
+                return self._cache[codec]
+            except KeyError:
                 pass
-            elif isinstance(value, Template):
-                if quote:
-                    if 2 <= self.debug:
-                        raise ValueError
-                    elif self.debug:
-                        yield '[ERROR: Template in a quoted context]'
-                else:
-                    for x in value.render(codec=codec, **kwargs):
-                        yield x
-            elif isinstance(value, dict):
+        out = []
+        self._render(out, codec, mergedict(self.kwargs, kwargs) if kwargs else self.kwargs)
+        data = ''.join( (x.encode(codec) if isinstance(x, unicode) else x) for x in out )
+        if self._static and not kwargs:
+            self._cache[codec] = data
+        return data
+
+    def _render(self, out, codec, kwargs):
+        for obj in self._code:
+            if not isinstance(obj, self.Variable):
+                out.append(obj)
+                continue
+            k = obj.name
+            if k not in kwargs:
+                out.append('[notfound:%s]' % k)
+                continue
+            value = kwargs[k]
+            if obj.type == '(':
+                self._render1(out, value, True, codec, kwargs)
+            elif obj.type == '[':
+                out.append(urlenc(value))
+            else:
+                self._render1(out, value, False, codec, kwargs)
+        return
+
+    def _render1(self, out, value, quote, codec, kwargs):
+        if value is None:
+            pass
+        elif isinstance(value, basestring):
+            if quote:
+                out.append(q(value))
+            else:
+                out.append(value)
+        elif isinstance(value, Template):
+            if quote:
                 if 2 <= self.debug:
                     raise ValueError
                 elif self.debug:
-                    yield '[ERROR: Dictionary included]'
-            elif isinstance(value, basestring):
-                if quote:
-                    yield q(value)
-                else:
-                    yield value
-            elif callable(value):
-                for x in render1(value(**kwargs), quote=quote):
-                    yield x
-            elif iterable(value):
-                for obj1 in value:
-                    for x in render1(obj1, quote=quote):
-                        yield x
+                    out.append('[ERROR: Template in a quoted context]')
             else:
-                if quote:
-                    yield q(unicode(value))
-                else:
-                    if 2 <= self.debug:
-                        raise ValueError
-                    elif self.debug:
-                        yield '[ERROR: Non-string object in a non-quoted context]'
-            return
-        for obj in self.objs:
-            if isinstance(obj, self.Variable):
-                k = obj.name
-                if k in kwargs:
-                    value = kwargs[k]
-                elif k in self.kwargs:
-                    value = self.kwargs[k]
-                else:
-                    yield '[notfound:%s]' % k
-                    continue
-                if obj.type == '(':
-                    for x in render1(value, quote=True):
-                        yield x
-                    continue
-                elif obj.type == '[':
-                    yield urlenc(value)
-                    continue
+                value._render(out, codec, mergedict(value.kwargs, kwargs))
+        elif isinstance(value, dict):
+            if 2 <= self.debug:
+                raise ValueError
+            elif self.debug:
+                out.append('[ERROR: Dictionary included]')
+        elif callable(value):
+            self._render1(out, value(**kwargs), quote, codec, kwargs)
+        elif iterable(value):
+            for obj1 in value:
+                self._render1(out, obj1, quote, codec, kwargs)
+        else:
+            if quote:
+                out.append(q(unicode(value)))
             else:
-                value = obj
-            for x in render1(value):
-                yield x
+                if 2 <= self.debug:
+                    raise ValueError
+                elif self.debug:
+                    out.append('[ERROR: Non-string object in a non-quoted context]')
         return
 
     _VARIABLE = re.compile(r'\$(\(\w+\)|\[\w+\]|<\w+>)')
@@ -181,6 +234,8 @@ class Router(object):
         self.method = method
         self.regex = regex
         self.func = func
+        code = func.func_code
+        self.args = code.co_varnames[1:code.co_argcount]
         return
 
     @staticmethod
@@ -213,6 +268,12 @@ class Redirect(Response):
         Response.__init__(self, '302 Found', Location=location)
         return
 
+class BadRequest(Response):
+
+    def __init__(self):
+        Response.__init__(self, '400 Bad Request')
+        return
+
 class NotFound(Response):
 
     def __init__(self):
@@ -232,28 +293,42 @@ class WebApp(object):
 
     debug = 0
     codec = 'utf-8'
+
+    @classmethod
+    def get_routes(klass):
+        # Routes are collected once per class.
+        if '_routes' not in klass.__dict__:
+            routes = {}
+            for attr in dir(klass):
+                router = getattr(klass, attr)
+                if not isinstance(router, Router): continue
+                routes.setdefault(router.method, []).append(router)
+            klass._routes = routes
+        return klass._routes
     
     def run(self, environ, start_response):
         method = environ.get('REQUEST_METHOD', 'GET')
         path = environ.get('PATH_INFO', '/')
         fp = environ.get('wsgi.input')
-        fields = cgi.FieldStorage(fp=fp, environ=environ)
+        fields = None
         result = None
-        for attr in dir(self):
-            router = getattr(self, attr)
-            if not isinstance(router, Router): continue
-            if router.method != method: continue
+        for router in self.get_routes().get(method, ()):
             m = router.regex.match(path)
             if m is None: continue
             params = m.groupdict().copy()
             params['_path'] = path
-            params['_fields'] = fields
             params['_environ'] = environ
-            code = router.func.func_code
-            args = code.co_varnames[:code.co_argcount]
+            if '_input' in router.args:
+                # The handler reads the body as is, whatever its type.
+                params['_input'] = iterbody(environ)
+            else:
+                fields = cgi.FieldStorage(fp=fp, environ=environ)
+                params['_fields'] = fields
+            # A non-form body (e.g. JSON) has no fields.
+            indexable = (fields is not None and fields.list is not None)
             kwargs = {}
-            for k in args[1:]:
-                if k in fields:
+            for k in router.args:
+                if indexable and k in fields:
                     kwargs[k] = fields.getvalue(k)
                 elif k in params:
                     kwargs[k] = params[k]
@@ -266,15 +341,14 @@ class WebApp(object):
                     result = [InternalError()]
             break
         if result is None:
+            if fields is None:
+                fields = cgi.FieldStorage(fp=fp, environ=environ)
             result = self.get_default(path, fields, environ)
         def f(obj):
             if isinstance(obj, Response):
                 start_response(obj.status, obj.headers)
             elif isinstance(obj, Template):
-                for x in obj.render(codec=self.codec):
-                    if isinstance(x, unicode):
-                        x = x.encode(self.codec)
-                    yield x
+                yield obj.tostring(codec=self.codec)
             elif iterable(obj):
                 for x in obj:
                     for y in f(x):
@@ -285,6 +359,10 @@ class WebApp(object):
                 yield obj
         return f(result)
 
+    # init_worker: called once in each worker before serving requests.
+    def init_worker(self):
+        return
+
     def get_default(self, path, fields, environ):
         return [NotFound(), '<html><body>not found</body></html>']
 
@@ -296,6 +374,136 @@ def run_server(host, port, app):
     httpd = make_server(host, port, app.run)
     httpd.serve_forever()
 
+# ThreadPoolMixIn: handles requests with a fixed number of threads.
+class ThreadPoolMixIn:
+
+    nthreads = 8
+
+    def start_threads(self):
+        import threading
+        from Queue import Queue
+        self._queue = Queue()
+        self._threads = []
+        for _ in xrange(self.nthreads):
+            thread = threading.Thread(target=self._process_requests)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return
+
+    def stop_threads(self):
+        # Let the threads finish the pending requests.
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        return
+
+    def process_request(self, request, client_address):
+        self._queue.put((request, client_address))
+        return
+
+    def _process_requests(self):
+        while 1:
+            item = self._queue.get()
+            if item is None: break
+            (request, client_address) = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
+        return
+
+def make_server_class(nthreads=0, backlog=5):
+    from wsgiref.simple_server import WSGIServer
+    if nthreads:
+        class Server(ThreadPoolMixIn, WSGIServer):
+            pass
+        Server.nthreads = nthreads
+    else:
+        class Server(WSGIServer):
+            pass
+    Server.request_queue_size = backlog
+    return Server
+
+# run_threaded: serves with a pool of threads.
+def run_threaded(host, port, app, nthreads=8, backlog=5):
+    import signal
+    import threading
+    from wsgiref.simple_server import make_server
+    print >>sys.stderr, 'Serving on %r port %d (%d threads)...' % (host, port, nthreads)
+    app.init_worker()
+    httpd = make_server(host, port, app.run,
+                        server_class=make_server_class(nthreads, backlog))
+    httpd.start_threads()
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.start()
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        while thread.is_alive():
+            thread.join(1)
+    except KeyboardInterrupt:
+        print >>sys.stderr, 'Shutting down...'
+    httpd.shutdown()
+    thread.join()
+    httpd.stop_threads()
+    httpd.server_close()
+    return
+
+# run_prefork: serves with forked processes sharing one socket.
+def run_prefork(host, port, app, nprocs=4, nthreads=0, backlog=5):
+    import os
+    import signal
+    from wsgiref.simple_server import make_server
+    print >>sys.stderr, 'Serving on %r port %d (%d processes)...' % (host, port, nprocs)
+    httpd = make_server(host, port, app.run,
+                        server_class=make_server_class(nthreads, backlog))
+    httpd.timeout = 0.5
+    stopping = []
+    def stop(signum, frame):
+        stopping.append(signum)
+    def serve():
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        # Other workers may take the connection first.
+        httpd.socket.setblocking(0)
+        app.init_worker()
+        if nthreads:
+            httpd.start_threads()
+        while not stopping:
+            httpd.handle_request()
+        if nthreads:
+            httpd.stop_threads()
+        httpd.server_close()
+        return
+    pids = []
+    for _ in xrange(nprocs):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve()
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    httpd.server_close()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while pids:
+        try:
+            (pid, _) = os.wait()
+            pids.remove(pid)
+        except OSError:
+            pass
+        if stopping:
+            print >>sys.stderr, 'Shutting down...'
+            for pid in pids:
+                os.kill(pid, signal.SIGTERM)
+            del stopping[:]
+    return
+
 # run_cgi
 def run_cgi(app):
     from wsgiref.handlers import CGIHandler
@@ -315,17 +523,24 @@ def run_httpcgi(app):
 def main(app, argv):
     import getopt
     def usage():
-        print 'usage: %s [-d] [-s] [host [port]]' % argv[0]
+        print ('usage: %s [-d] [-s] [-t threads] [-p processes] [-q backlog] [host [port]]' %
+               argv[0])
         return 100
     try:
-        (opts, args) = getopt.getopt(argv[1:], 'ds')
+        (opts, args) = getopt.getopt(argv[1:], 'dst:p:q:')
     except getopt.GetoptError:
         return usage()
     server = False
     debug = 0
+    nthreads = 0
+    nprocs = 0
+    backlog = 5
     for (k, v) in opts:
         if k == '-d': debug += 1
         elif k == '-s': server = True
+        elif k == '-t': nthreads = int(v)
+        elif k == '-p': nprocs = int(v)
+        elif k == '-q': backlog = int(v)
     Template.debug = debug
     WebApp.debug = debug
     if server:
@@ -335,7 +550,12 @@ def main(app, argv):
             host = args.pop(0)
         if args:
             port = int(args.pop(0))
-        run_server(host, port, app)
+        if nprocs:
+            run_prefork(host, port, app, nprocs=nprocs, nthreads=nthreads, backlog=backlog)
+        elif nthreads:
+            run_threaded(host, port, app, nthreads=nthreads, backlog=backlog)
+        else:
+            run_server(host, port, app)
     else:
         run_httpcgi(app)
     return
@@ -343,55 +563,103 @@ def main(app, argv):
 
 ##  NLCryptApp
 ##
-from nlcrypt import NLCrypt
+import json
+import hashlib
+import itertools
+from nlcrypt import NLCrypt, Dictionary, LRUCache
 from random import choice, randrange
 class NLCryptHTML(NLCrypt):
 
-    def __init__(self, key, reverse=False, cbc=False, basedir='.', debug=0):
+    def __init__(self, key, reverse=False, cbc=False, basedir='.', debug=0,
+                 offsets=None, dictionary=None):
         NLCrypt.__init__(self, key, reverse=reverse, cbc=cbc,
-                         basedir=basedir, debug=debug)
+                         basedir=basedir, debug=debug, offsets=offsets,
+                         dictionary=dictionary)
         self.logs = []
         return
         
     def _debug_ignore(self, w):
         return
         
+    WORD_LOG = Template(
+        '<span class=item>Word</span> ($(grp)): '
+        '<em>$(w0)</em>($(n0)) &rarr; <em>$(w1)</em>($(n1))<br>\n')
     def _debug_word(self, w0,n0, grp, w1,n1):
         if self.debug:
             self.logs.append(
-                Template(
-                    '<span class=item>Word</span> ($(grp)): '
-                    '<em>$(w0)</em>($(n0)) &rarr; <em>$(w1)</em>($(n1))<br>\n',
-                    grp=grp, w0=w0, n0=n0, w1=w1, n1=n1))
+                self.WORD_LOG(grp=grp, w0=w0, n0=n0, w1=w1, n1=n1))
         return
         
+    LETTER_LOG = Template(
+        '<span class=item>Letter</span>: '
+        '<em>$(w0)</em> &rarr; <em>$(w1)</em><br>\n')
     def _debug_unknown(self, w0, w1):
         if self.debug:
             self.logs.append(
-                Template(
-                    '<span class=item>Letter</span>: '
-                    '<em>$(w0)</em> &rarr; <em>$(w1)</em><br>\n',
-                    w0=w0, w1=w1))
+                self.LETTER_LOG(w0=w0, w1=w1))
         return
 
 class NLCryptApp(WebApp):
 
+    BASEDIR = '.'
     MAXCHARS = 2000
+
+    # Per-key state (ECB offsets) kept between requests.
+    # The cache size is the total number of the offsets of all the keys.
+    CONTEXT_CACHE_SIZE = 100000
+    CONTEXT_TTL = 600
+    CONTEXTS = LRUCache(CONTEXT_CACHE_SIZE, ttl=CONTEXT_TTL)
     OPTIONS = (('eb', 'Encryption'),
                ('db', 'Decryption'),
                ('ec', 'Encryption (CBC)'),
                ('dc', 'Decryption (CBC)'))
 
+    # Templates are parsed once.
+    INFO = Template(
+        '<p class=info> NLCrypt is a casual cryptography system '
+        'that disguises a secret message as a grammatical (but nonsensical) text. '
+        '<a href="https://github.com/euske/nlcrypt">[More info]</a>\n'
+        '<div class=warning>Warning: '
+        'Do NOT use this for credit card numbers or passwords.</div>')
+    ERROR_KEY = Template(
+        '<div class=error>Error: Provide an encryption key.</div>\n')
+    ERROR_OPTION = Template(
+        '<div class=error>Error: Invalid option.</div>\n')
+    NOTICE_TRUNCATED = Template(
+        '<div class=error>Notice: Text is truncated to 2,000 letters.</div>\n')
+    RESULT = Template(
+        '<div class=result>Result ($(opt)):</div>\n'
+        '<blockquote>$(s)</blockquote>\n')
+    DEBUG = Template('<div class=debug>Debug Information:</div>\n')
+
+    def init_worker(self):
+        # Opened once per process and shared by all the requests.
+        Dictionary.load(self.BASEDIR)
+        return
+
+    def _context_key(self, key):
+        # The raw key is not kept in the cache.
+        return hashlib.sha1(self.BASEDIR+'\0'+key).digest()
+
+    def get_offsets(self, key):
+        h = self._context_key(key)
+        offsets = self.CONTEXTS.get(h)
+        if offsets is None:
+            offsets = {}
+            self.CONTEXTS.put(h, offsets)
+        return offsets
+
+    def put_offsets(self, key, offsets):
+        # Called after the table is used, as it grows with every
+        # (grp, n) it sees.
+        self.CONTEXTS.put(self._context_key(key), offsets, size=1+len(offsets))
+        return
+
     @GET('/')
     def index(self):
         yield Response()
         yield self.header()
-        yield Template(
-            '<p class=info> NLCrypt is a casual cryptography system '
-            'that disguises a secret message as a grammatical (but nonsensical) text. '
-            '<a href="https://github.com/euske/nlcrypt">[More info]</a>\n'
-            '<div class=warning>Warning: '
-            'Do NOT use this for credit card numbers or passwords.</div>')
+        yield self.INFO
         k = u''.join( choice('abcdefghijklmnopqrstuvwxyz') for _ in range(randrange(5,10)) )
         s = u''
         try:
@@ -415,85 +683,166 @@ class NLCryptApp(WebApp):
         debug = bool(d)
         crypt = None
         if not k:
-            yield Template(
-                '<div class=error>Error: Provide an encryption key.</div>\n')
+            yield self.ERROR_KEY
         elif t not in options:
-            yield Template(
-                '<div class=error>Error: Invalid option.</div>\n')
+            yield self.ERROR_OPTION
         elif s:
-            crypt = NLCryptHTML(k, reverse=decrypt, cbc=cbc, debug=debug)
+            offsets = (None if cbc else self.get_offsets(k))
+            crypt = NLCryptHTML(k, reverse=decrypt, cbc=cbc, debug=debug, offsets=offsets,
+                                dictionary=Dictionary.load(self.BASEDIR))
             if self.MAXCHARS < len(s):
                 s = s[:self.MAXCHARS]
-                yield Template(
-                    '<div class=error>Notice: Text is truncated to 2,000 letters.</div>\n')
-            s = crypt.feed(s)
+                yield self.NOTICE_TRUNCATED
+            s = crypt.feed(s) + crypt.flush()
+            if offsets is not None:
+                self.put_offsets(k, offsets)
             decrypt = (not decrypt)
-            yield Template(
-                '<div class=result>Result ($(opt)):</div>\n'
-                '<blockquote>$(s)</blockquote>\n',
-                opt=options[t], s=s)
+            yield self.RESULT(opt=options[t], s=s)
         yield self.form(s=s, k=k, decrypt=decrypt, cbc=cbc, debug=debug)
         if crypt is not None and crypt.logs:
-            yield Template('<div class=debug>Debug Information:</div>\n')
+            yield self.DEBUG
             yield crypt.logs
         yield self.footer()
         return
 
-    def header(self):
-        return Template(
-            '<html><head>\n'
-            '<title>NLCrypt : Semantic Cryptography</title>\n'
-            '<style><!--\n'
-            'h1 { border-bottom:2pt solid black; }\n'
-            'h1 a { text-decoration:none; }\n'
-            'blockquote { background:#eeeeee; }\n'
-            '.debug { font-size:120%; font-weight:bold; color:magenta; }\n'
-            '.error { font-size:120%; font-weight:bold; color:red; }\n'
-            '.result { font-size:120%; font-weight:bold; color:green; }\n'
-            '.item { font-weight:bold; color:blue; }\n'
-            '.warning { font-weight:bold; color:red; }\n'
-            '.info { font-size:80%; }\n'
-            '--></style>\n'
-            '</head><body>\n'
-            '<h1><a href="/">NLCrypt : Semantic Cryptography</a></h1>\n'
-            )
+    # Maximum length of a text in the JSON API.
+    API_MAXCHARS = 100000
+
+    @POST('/api/crypt')
+    def api_crypt(self, _input=()):
+        # Encrypts/decrypts a batch of items.
+        #   The body is a JSON array or JSON lines of objects like
+        #   {"text": ..., "key": ..., "mode": "eb", "id": ...}, where mode
+        #   is one of OPTIONS. A result {"text": ...} or {"error": ...} is
+        #   sent for each item as a line as soon as it is done.
+        #   The body is read as JSON whatever its Content-Type.
+        lines = iter(_input)
+        line = ''
+        for line in lines:
+            if line.strip(): break
+        if line.lstrip().startswith('['):
+            try:
+                items = json.loads(line+''.join(lines))
+            except ValueError:
+                items = None
+            if not isinstance(items, list):
+                yield BadRequest()
+                yield '<html><body>invalid JSON</body></html>'
+                return
+        else:
+            items = self._iter_json_lines(line, lines)
+        yield Response(content_type='application/x-ndjson')
+        # The dictionary and the sessions for each key are
+        # shared by all the items.
+        dictionary = Dictionary.load(self.BASEDIR)
+        sessions = {}
+        for item in items:
+            yield json.dumps(self._crypt_item(item, dictionary, sessions))+'\n'
+        return
 
-    def footer(self):
-        return Template(
-            '<hr>\n'
-            '<div class=info><strong>Disclaimer:</strong> '
-            'This is an experimental website. The information you send is not protected. '
-            'The cryptography can be changed without notice. Use at your own risk. '
-            '</div>\n'
-            '<address>Yusuke Shinyama</address>\n'
-            '</body></html>\n')
+    def _iter_json_lines(self, line, lines):
+        for line in itertools.chain([line], lines):
+            if not line.strip(): continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+        return
 
+    def _crypt_item(self, item, dictionary, sessions):
+        if not isinstance(item, dict):
+            return {'error': 'invalid item'}
+        result = {}
+        if 'id' in item:
+            result['id'] = item['id']
+        s = item.get('text', u'')
+        k = item.get('key', u'')
+        t = item.get('mode', 'eb')
+        if not isinstance(s, basestring) or not isinstance(k, basestring):
+            result['error'] = 'invalid item'
+        elif not k:
+            result['error'] = 'no key'
+        elif not isinstance(t, basestring) or t not in dict(self.OPTIONS):
+            result['error'] = 'invalid mode'
+        else:
+            # Keys are used as encoded by the HTML form.
+            k = k.encode(self.codec)
+            session = sessions.get((k,t))
+            if session is None:
+                cbc = t.endswith('c')
+                offsets = (None if cbc else self.get_offsets(k))
+                crypt = NLCrypt(k, reverse=t.startswith('d'), cbc=cbc, offsets=offsets,
+                                dictionary=dictionary)
+                sessions[(k,t)] = (crypt, offsets)
+            else:
+                (crypt, offsets) = session
+                crypt.reset()
+            if self.API_MAXCHARS < len(s):
+                s = s[:self.API_MAXCHARS]
+                result['truncated'] = True
+            result['text'] = crypt.feed(s) + crypt.flush()
+            if offsets is not None:
+                self.put_offsets(k, offsets)
+        return result
+
+    HEADER = Template(
+        '<html><head>\n'
+        '<title>NLCrypt : Semantic Cryptography</title>\n'
+        '<style><!--\n'
+        'h1 { border-bottom:2pt solid black; }\n'
+        'h1 a { text-decoration:none; }\n'
+        'blockquote { background:#eeeeee; }\n'
+        '.debug { font-size:120%; font-weight:bold; color:magenta; }\n'
+        '.error { font-size:120%; font-weight:bold; color:red; }\n'
+        '.result { font-size:120%; font-weight:bold; color:green; }\n'
+        '.item { font-weight:bold; color:blue; }\n'
+        '.warning { font-weight:bold; color:red; }\n'
+        '.info { font-size:80%; }\n'
+        '--></style>\n'
+        '</head><body>\n'
+        '<h1><a href="/">NLCrypt : Semantic Cryptography</a></h1>\n'
+        )
+    def header(self):
+        return self.HEADER
+
+    FOOTER = Template(
+        '<hr>\n'
+        '<div class=info><strong>Disclaimer:</strong> '
+        'This is an experimental website. The information you send is not protected. '
+        'The cryptography can be changed without notice. Use at your own risk. '
+        '</div>\n'
+        '<address>Yusuke Shinyama</address>\n'
+        '</body></html>\n')
+    def footer(self):
+        return self.FOOTER
+
+    FORM_BEGIN = Template(
+        '<form method="POST" action="/crypt">\n'
+        '<div><textarea name="s" cols="80" rows="8">$(s)</textarea></div>\n'
+        '<div><select name="t">')
+    FORM_OPTION = Template(
+        '<option value="$(t)" $(selected)>$(v)</option>')
+    FORM_END = Template(
+        '</select> &nbsp;'
+        'with Key <input name="k" size="10" value="$(k)"> &nbsp;'
+        '<label for="debug">'
+        '<input id="debug" name="d" type=checkbox $(checked)> Debug mode'
+        '</label> &nbsp;'
+        '<input type=submit value="Submit"> &nbsp;'
+        '<input type=reset> &nbsp;'
+        '</div></form>\n')
     def form(self,
              s=u'Type text here.',
              k=u'',
              decrypt=False, cbc=False, debug=False):
-        yield Template(
-            '<form method="POST" action="/crypt">\n'
-            '<div><textarea name="s" cols="80" rows="8">$(s)</textarea></div>\n'
-            '<div><select name="t">',
-            s=s)
+        yield self.FORM_BEGIN(s=s)
         for (t,v) in self.OPTIONS:
             selected = ('selected'
                         if (decrypt == t.startswith('d') and cbc == t.endswith('c'))
                         else '')
-            yield Template('<option value="$(t)" $(selected)>$(v)</option>',
-                           selected=selected, t=t, v=v)
+            yield self.FORM_OPTION(selected=selected, t=t, v=v)
         checked = ('checked' if debug else '')
-        yield Template(
-            '</select> &nbsp;'
-            'with Key <input name="k" size="10" value="$(k)"> &nbsp;'
-            '<label for="debug">'
-            '<input id="debug" name="d" type=checkbox $(checked)> Debug mode'
-            '</label> &nbsp;'
-            '<input type=submit value="Submit"> &nbsp;'
-            '<input type=reset> &nbsp;'
-            '</div></form>\n',
-            checked=checked, k=k)
+        yield self.FORM_END(checked=checked, k=k)
         return
 
 if __name__ == '__main__': sys.exit(main(NLCryptApp(), sys.argv))
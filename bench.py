@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+##
+##  bench.py - Benchmarks for NLCrypt
+##
+##  Usage:
+##    $ bench.py [options] [file ...]
+##
+##  Options:
+##    -b basedir        Directory for dictionary files.
+##    -o output         Writes the results as JSON (default: bench.json)
+##    -c baseline       Compares the results with a previous JSON file.
+##    -n words          Number of words in the synthetic corpus (default: 10000)
+##    -r repeat         Number of runs of each benchmark (default: 3)
+##
+import sys
+import time
+import json
+import random
+import platform
+import os.path
+import arcfour
+import nlcrypt
+from nlcrypt import NLCrypt, Dictionary, CompactDictionary
+
+MODES = (
+    ('ecb', False, False),
+    ('ecb-reverse', False, True),
+    ('cbc', True, False),
+    ('cbc-reverse', True, True),
+)
+
+
+##  StageTimer
+##
+##  Accumulates the time spent in each stage of the pipeline.
+##  Only the innermost operations are timed so that stages do not overlap.
+##
+class StageTimer(object):
+
+    STAGES = ('segment', 'lookup', 'hmac', 'arcfour', 'output')
+
+    def __init__(self):
+        self.times = dict( (k,0.0) for k in self.STAGES )
+        return
+
+    def wrap(self, name, func):
+        times = self.times
+        def wrapper(*args, **kwargs):
+            t0 = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                times[name] += time.time()-t0
+        return wrapper
+
+    def wrapgen(self, name, func):
+        times = self.times
+        def wrapper(*args, **kwargs):
+            it = func(*args, **kwargs)
+            while 1:
+                t0 = time.time()
+                try:
+                    x = it.next()
+                except StopIteration:
+                    times[name] += time.time()-t0
+                    return
+                times[name] += time.time()-t0
+                yield x
+        return wrapper
+
+class TimedHMAC(object):
+
+    def __init__(self, hmac, timer):
+        self._hmac = hmac
+        self.digest = timer.wrap('hmac', hmac.digest)
+        self.update = timer.wrap('hmac', hmac.update)
+        return
+
+class TimedArcfourModule(object):
+
+    def __init__(self, timer):
+        class TimedArcfour(arcfour.Arcfour):
+            process = timer.wrap('arcfour', arcfour.Arcfour.process)
+        self.Arcfour = timer.wrap('arcfour', TimedArcfour)
+        return
+
+# instrument: replaces the stages of an NLCrypt object with timed ones.
+def instrument(crypt, timer):
+    crypt._hmac = TimedHMAC(crypt._hmac, timer)
+    crypt._tokenize = timer.wrapgen('segment', crypt._tokenize)
+    # _resolve includes the memo and calls _word2group.
+    for name in ('_resolve', '_group2words'):
+        setattr(crypt, name, timer.wrap('lookup', getattr(crypt, name)))
+    for name in ('_handle_a', '_put_space', '_put_word'):
+        setattr(crypt, name, timer.wrap('output', getattr(crypt, name)))
+    return crypt
+
+
+##  Corpora
+##
+def get_vocabulary(basedir):
+    path = os.path.join(basedir, 'nlcrypt.dic')
+    if os.path.exists(path):
+        words = []
+        for (_,group) in CompactDictionary(path).itergroups():
+            words.extend(group)
+        return words
+    import pycdb
+    words = []
+    for (k,v) in pycdb.cdbdump(os.path.join(basedir, 'g2w.cdb')):
+        if k.startswith('#'): continue
+        words.extend(v.decode('utf-8').split(' '))
+    return words
+
+# make_corpus: makes random sentences with words from the dictionary.
+def make_corpus(words, nwords, seed=0):
+    rnd = random.Random(seed)
+    words = sorted(words)
+    lines = []
+    sent = []
+    for _ in xrange(nwords):
+        w = rnd.choice(words).replace('_', ' ')
+        if not sent:
+            w = w[0].upper()+w[1:]
+        sent.append(w)
+        if rnd.random() < 0.1:
+            lines.append(u' '.join(sent)+u'.\n')
+            sent = []
+    if sent:
+        lines.append(u' '.join(sent)+u'.\n')
+    return lines
+
+def read_corpus(path, codec='utf-8'):
+    fp = file(path, 'rb')
+    lines = [ line.decode(codec, 'ignore') for line in fp ]
+    fp.close()
+    return lines
+
+
+##  Benchmark
+##
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values)*p))]
+
+def run_feed(crypt, lines):
+    latency = []
+    output = []
+    for line in lines:
+        t0 = time.time()
+        output.append(crypt.feed(line))
+        latency.append(time.time()-t0)
+    output.append(crypt.flush())
+    return (output, latency)
+
+def bench(name, lines, basedir='.', key='benchmark', repeat=3):
+    nwords = sum( len(NLCrypt.WORD.findall(line)) for line in lines )
+    results = []
+    for (mode, cbc, reverse) in MODES:
+        data = lines
+        if reverse:
+            # Decrypt the ciphertext.
+            (data, _) = run_feed(NLCrypt(key, cbc=cbc, basedir=basedir), lines)
+            data = u''.join(data).splitlines(True)
+        # Each run gets a fresh Dictionary so that it starts with an
+        # empty memo instead of the one left by the previous run.
+        best = None
+        for _ in xrange(repeat):
+            crypt = NLCrypt(key, reverse=reverse, cbc=cbc,
+                            dictionary=Dictionary(basedir))
+            t0 = time.time()
+            (_, latency) = run_feed(crypt, data)
+            t = time.time()-t0
+            if best is None or t < best[0]:
+                best = (t, latency)
+        (t, latency) = best
+        # Breakdown with a separate, instrumented run.
+        timer = StageTimer()
+        crypt = instrument(NLCrypt(key, reverse=reverse, cbc=cbc,
+                                   dictionary=Dictionary(basedir)), timer)
+        arcfour0 = nlcrypt.arcfour
+        nlcrypt.arcfour = TimedArcfourModule(timer)
+        try:
+            t0 = time.time()
+            run_feed(crypt, data)
+            total = time.time()-t0
+        finally:
+            nlcrypt.arcfour = arcfour0
+        stages = dict( (k, v/total) for (k,v) in timer.times.iteritems() )
+        stages['other'] = max(0.0, 1.0-sum(stages.itervalues()))
+        result = {
+            'corpus': name,
+            'mode': mode,
+            'lines': len(data),
+            'words': nwords,
+            'seconds': t,
+            'words_per_sec': nwords/t if t else 0.0,
+            'latency': {
+                'mean': sum(latency)/len(latency) if latency else 0.0,
+                'p50': percentile(latency, 0.50) if latency else 0.0,
+                'p99': percentile(latency, 0.99) if latency else 0.0,
+            },
+            'stages': stages,
+        }
+        print >>sys.stderr, ('%-12s %-12s %8d words %10.1f words/sec  ' % 
+                             (name, mode, nwords, result['words_per_sec'])+
+                             ' '.join( '%s=%.0f%%' % (k, stages[k]*100)
+                                       for k in StageTimer.STAGES+('other',) ))
+        results.append(result)
+    return results
+
+# compare: prints the speed relative to a previous run.
+def compare(results, baseline):
+    prev = dict( ((r['corpus'], r['mode']), r) for r in baseline['results'] )
+    for r in results:
+        k = (r['corpus'], r['mode'])
+        if k not in prev or not prev[k]['words_per_sec']: continue
+        ratio = r['words_per_sec'] / prev[k]['words_per_sec']
+        print >>sys.stderr, '%-12s %-12s %6.2fx' % (k[0], k[1], ratio)
+    return
+
+# main
+def main(argv):
+    import getopt
+    def usage():
+        print 'usage: %s [-b basedir] [-o output] [-c baseline] [-n words] [-r repeat] [file ...]' % argv[0]
+        return 100
+    try:
+        (opts, args) = getopt.getopt(argv[1:], 'b:o:c:n:r:')
+    except getopt.GetoptError:
+        return usage()
+    basedir = '.'
+    output = 'bench.json'
+    baseline = None
+    nwords = 10000
+    repeat = 3
+    for (k, v) in opts:
+        if k == '-b': basedir = v
+        elif k == '-o': output = v
+        elif k == '-c': baseline = v
+        elif k == '-n': nwords = int(v)
+        elif k == '-r': repeat = int(v)
+    if not args:
+        args = ['sample.txt', 'quotes.txt']
+    corpora = [ (os.path.basename(path), read_corpus(path)) for path in args ]
+    if nwords:
+        words = get_vocabulary(basedir)
+        corpora.append(('synthetic', make_corpus(words, nwords)))
+    results = []
+    for (name, lines) in corpora:
+        results.extend(bench(name, lines, basedir=basedir, repeat=repeat))
+    fp = file(output, 'w')
+    json.dump({
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }, fp, indent=1, sort_keys=True)
+    fp.close()
+    print >>sys.stderr, 'Written: %r' % output
+    if baseline is not None:
+        fp = file(baseline, 'r')
+        compare(results, json.load(fp))
+        fp.close()
+    return 0
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
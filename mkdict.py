@@ -7,10 +7,16 @@ import sys
 import re
 import os.path
 import math
+import struct
+from array import array
+from cStringIO import StringIO
 try:
   import cdb
 except ImportError:
   import pycdb as cdb
+from nlcrypt import DICT_MAGIC, DICT_VERSION, DICT_VERSION_MPH, DICT_HEADER, DICT_SEED, DICT_NOGROUP
+from nlcrypt import dicthash, mphhash, mphslot
+from nlcrypt import BloomFilter, BLOOM_BITS_PER_KEY, dictstamps
 
 C = 1.0/math.log(2)
 def convfreq(n):
@@ -104,19 +110,116 @@ def get_superlative(s, exc):
     return s+'est'
 
 
+# add pairs in bulk if the cdb module supports it.
+def cdbextend(maker, pairs):
+  if hasattr(maker, 'extend'):
+    maker.extend(pairs)
+  else:
+    for (k,v) in pairs:
+      maker.add(k, v)
+  return
+
+# little-endian uint32 array.
+def encode(a):
+  if sys.byteorder == 'big':
+    a.byteswap()
+  return a.tostring()
+
+# offsets of each word in a space-joined group (plus the end).
+def get_index(words, i=0):
+  a = array('I')
+  for w in words:
+    a.append(i)
+    i += len(w)+1
+  a.append(i)
+  return encode(a)
+
+# Number of the seeds tried for a perfect hash.
+MPH_TRIES = 100
+
+# make_mph: builds a minimal perfect hash (hash and displace).
+#   Returns the displacements of the buckets and the slot of each key,
+#   or None if the hash with this seed has no solution.
+def make_mph(keys, seed=0):
+  n = len(keys)
+  hashes = [ mphhash(k, seed) for k in keys ]
+  buckets = [ [] for _ in xrange(n) ]
+  for (i,(h0,_,_)) in enumerate(hashes):
+    buckets[h0 % n].append(i)
+  disps = array('i', [0]*n)
+  slots = [None]*n
+  used = [False]*n
+  # Place the largest buckets first by searching a displacement
+  # that puts all of their keys in free slots.
+  order = sorted(xrange(n), key=lambda b: len(buckets[b]), reverse=True)
+  j = 0
+  for (j,b) in enumerate(order):
+    bucket = buckets[b]
+    if len(bucket) < 2: break
+    # The slots repeat after n displacements.
+    for d in xrange(n):
+      xs = [ mphslot(d, hashes[i][1], hashes[i][2], n) for i in bucket ]
+      if len(set(xs)) == len(xs) and not any( used[x] for x in xs ): break
+    else:
+      return None
+    disps[b] = d
+    for (i,x) in zip(bucket, xs):
+      slots[i] = x
+      used[x] = True
+  # The remaining single-key buckets point to a free slot directly.
+  free = ( x for x in xrange(n) if not used[x] )
+  for b in order[j:]:
+    bucket = buckets[b]
+    if not bucket: break
+    x = free.next()
+    disps[b] = -x-1
+    slots[bucket[0]] = x
+  return (disps, slots)
+
+
+# _read_index: parses an index file in a worker process.
+_converter = None
+def _read_index(name):
+  converter = _converter
+  words = {}
+  order = []
+  for (w0, w, pos) in converter._parse(name):
+    if w in words:
+      tags = words[w][1]
+      if pos not in tags:
+        tags.append(pos)
+    else:
+      words[w] = (converter.weight.get(w0, 0), [pos])
+      order.append(w)
+  return [ (w,)+words[w] for w in order ]
+
+
 ##  DictionaryConverter
 ##
 class DictionaryConverter(object):
 
+  INPUTS = ('noun.exc', 'adj.exc', 'adv.exc', 'verb.exc', 'cntlist',
+            'index.adj', 'index.adv', 'index.noun', 'index.verb')
+  CACHE_VERSION = 1
+
   def __init__(self, basedir):
     self.basedir = basedir
-    self.read_noun_exc()
-    self.read_adj_exc()
-    self.read_adv_exc()
-    self.read_verb_exc()
-    self.read_cntlist()
     self.skip = set()
     self._words = {}
+    self._loaded = False
+    self._sorted = None
+    # groups and skip list saved in the cache.
+    self._prev = None
+    return
+
+  def load(self):
+    if not self._loaded:
+      self.read_noun_exc()
+      self.read_adj_exc()
+      self.read_adv_exc()
+      self.read_verb_exc()
+      self.read_cntlist()
+      self._loaded = True
     return
 
   def _open_file(self, name):
@@ -202,6 +305,36 @@ class DictionaryConverter(object):
 
   pat_word = re.compile(r'^[a-zA-Z]+$')
   def read(self, name):
+    self.load()
+    for (w0, w, pos) in self._parse(name):
+      self._add_pos(w0, w, pos)
+    return self
+
+  # read_all: reads the index files in parallel and merges them in order.
+  def read_all(self, names, nprocs=1):
+    global _converter
+    self.load()
+    if nprocs <= 1:
+      for name in names:
+        self.read(name)
+    else:
+      from multiprocessing import Pool
+      # Workers are forked with this converter.
+      _converter = self
+      pool = Pool(min(nprocs, len(names)))
+      try:
+        results = pool.map(_read_index, names)
+      finally:
+        pool.close()
+        pool.join()
+        _converter = None
+      for words in results:
+        self._merge(words)
+    self._compact()
+    return self
+
+  # _parse: yields (lemma, inflected form, pos) for each index file.
+  def _parse(self, name):
     fp = self._open_file('index.'+name)
     for line in fp:
       if line.startswith(' '): continue
@@ -211,33 +344,35 @@ class DictionaryConverter(object):
       if len(w) < 2: continue
       w = w.lower()
       if t == 'a':              # adj
-        self._add_pos(w, w, 'JJ')
-        self._add_pos(w, get_comparative(w, self.jjr_exc), 'JJR')
-        self._add_pos(w, get_superlative(w, self.jjs_exc), 'JJS')
+        yield (w, w, 'JJ')
+        yield (w, get_comparative(w, self.jjr_exc), 'JJR')
+        yield (w, get_superlative(w, self.jjs_exc), 'JJS')
       elif t == 'r':            # adv
-        self._add_pos(w, w, 'RB')
-        self._add_pos(w, get_comparative(w, self.rbr_exc), 'RBR')
-        self._add_pos(w, get_superlative(w, self.rbs_exc), 'RBS')
+        yield (w, w, 'RB')
+        yield (w, get_comparative(w, self.rbr_exc), 'RBR')
+        yield (w, get_superlative(w, self.rbs_exc), 'RBS')
       elif t == 'n':            # noun
-        self._add_pos(w, w, 'NN')
-        self._add_pos(w, get_plural(w, self.nns_exc), 'NNS')
+        yield (w, w, 'NN')
+        yield (w, get_plural(w, self.nns_exc), 'NNS')
       elif t == 'v':            # verb
-        self._add_pos(w, w, 'VB')
-        self._add_pos(w, w, 'VBP')
-        self._add_pos(w, get_pres3rd(w, self.vbz_exc), 'VBZ')
-        self._add_pos(w, get_past(w, self.vbd_exc), 'VBD')
-        self._add_pos(w, get_pastpart(w, self.vbn_exc), 'VBN')
+        yield (w, w, 'VB')
+        yield (w, w, 'VBP')
+        yield (w, get_pres3rd(w, self.vbz_exc), 'VBZ')
+        yield (w, get_past(w, self.vbd_exc), 'VBD')
+        yield (w, get_pastpart(w, self.vbn_exc), 'VBN')
         if not '_' in w:
-          self._add_pos(w, get_gerund(w, self.vbg_exc), 'VBG')
+          yield (w, get_gerund(w, self.vbg_exc), 'VBG')
       else:
         assert 0, (w, t)
-        
-    return self
+    fp.close()
+    return
 
   def _add_pos(self, w0, w, pos):
-    if w in self.skip: return
     if w in self._words:
-      (_,poss) = self._words[w]
+      (n,poss) = self._words[w]
+      if not isinstance(poss, set):
+        poss = set(poss)
+        self._words[w] = (n, poss)
     else:
       n = self.weight.get(w0, 0)
       poss = set()
@@ -245,50 +380,274 @@ class DictionaryConverter(object):
     poss.add(pos)
     return
 
-  def write(self, g2wpath, w2gpath):
-    print >>sys.stderr, 'Sorting...'
+  def _merge(self, words):
+    # Same insertion order as reading the files one by one.
+    for (w, n, tags) in words:
+      if w in self._words:
+        (_,poss) = self._words[w]
+      else:
+        poss = set()
+        self._words[w] = (n, poss)
+      for pos in tags:
+        poss.add(pos)
+    return
+
+  def _compact(self):
+    # Replace the sets with shared tuples (in the same order).
+    posses = {}
+    for (w, (n,poss)) in self._words.iteritems():
+      poss = tuple(poss)
+      self._words[w] = (n, posses.setdefault(poss, poss))
+    return
+
+  def _get_group(self, w):
+    (n,poss) = self._words[w]
+    return '%s:%d' % ('+'.join(poss), n)
+
+  def _make_groups(self):
     grp2words = {}
     for (w, (n,poss)) in self._words.iteritems():
+      if w in self.skip: continue
       grp = '%s:%d' % ('+'.join(poss), n)
       if grp not in grp2words: grp2words[grp] = []
       grp2words[grp].append(w)
+    for words in grp2words.itervalues():
+      words.sort()
+    return grp2words
+
+  def _update_groups(self):
+    # Only the groups of the words whose skip status changed are rebuilt.
+    (prev_groups, prev_skip) = self._prev
+    changed = [ w for w in (self.skip ^ prev_skip) if w in self._words ]
+    affected = set( self._get_group(w) for w in changed )
+    print >>sys.stderr, 'Updating %d groups...' % len(affected)
+    grp2words = {}
+    for (grp, words) in prev_groups.iteritems():
+      if grp not in affected:
+        grp2words[grp] = words
+      else:
+        grp2words[grp] = [ w for w in words if w not in self.skip ]
+    for w in changed:
+      if w not in self.skip:
+        grp = self._get_group(w)
+        if grp not in grp2words: grp2words[grp] = []
+        grp2words[grp].append(w)
+    for grp in affected:
+      if grp2words.get(grp):
+        grp2words[grp].sort()
+      elif grp in grp2words:
+        del grp2words[grp]
+    return grp2words
+
+  def _sort(self):
+    if self._sorted is not None:
+      return self._sorted
+    print >>sys.stderr, 'Sorting...'
+    if self._prev is not None:
+      grp2words = self._update_groups()
+    else:
+      grp2words = self._make_groups()
     word2grp = {}
     r = sorted(grp2words.iteritems(), key=lambda (k,v):len(v), reverse=True)
     for (grp, words) in r:
-      words.sort()
       for (n,w) in enumerate(words):
         word2grp[w] = (grp, n)
       print >>sys.stderr, ' Group: %r (%d)' % (grp, len(words))
+    self._sorted = (grp2words, word2grp)
+    return self._sorted
+
+  def _get_stamp(self):
+    stamp = [self.CACHE_VERSION]
+    for name in self.INPUTS:
+      st = os.stat(os.path.join(self.basedir, name))
+      stamp.append((name, st.st_size, st.st_mtime))
+    return stamp
+
+  # load_cache: loads the parsed WordNet data saved by save_cache().
+  #   Returns False if the cache is missing or out of date.
+  def load_cache(self, path):
+    import cPickle as pickle
+    try:
+      fp = file(path, 'rb')
+    except IOError:
+      return False
+    try:
+      (stamp, words, groups, skip) = pickle.load(fp)
+    except Exception:
+      return False
+    finally:
+      fp.close()
+    if stamp != self._get_stamp():
+      return False
+    print >>sys.stderr, 'Loaded: %r' % path
+    self._words = words
+    self._prev = (groups, skip)
+    self._sorted = None
+    return True
+
+  def save_cache(self, path):
+    import cPickle as pickle
+    (grp2words, _) = self._sort()
+    print >>sys.stderr, 'Writing: %r' % path
+    fp = file(path+'.tmp', 'wb')
+    pickle.dump((self._get_stamp(), self._words, grp2words, self.skip),
+                fp, pickle.HIGHEST_PROTOCOL)
+    fp.close()
+    os.rename(path+'.tmp', path)
+    return
+
+  def write(self, g2wpath, w2gpath):
+    (grp2words, word2grp) = self._sort()
     print >>sys.stderr, 'Writing: %r' % g2wpath
     g2w = cdb.cdbmake(g2wpath, g2wpath+'.tmp')
-    for (grp,words) in grp2words.iteritems():
-      g2w.add(grp, ' '.join(words))
+    def g2w_pairs():
+      for (grp,words) in grp2words.iteritems():
+        yield (grp, ' '.join(words))
+        yield ('#'+grp, get_index(words))
+    cdbextend(g2w, g2w_pairs())
     g2w.finish()
     print >>sys.stderr, 'Writing: %r' % w2gpath
     w2g = cdb.cdbmake(w2gpath, w2gpath+'.tmp')
-    for (word,(grp,n)) in word2grp.iteritems():
-      w2g.add(word, '%s,%d' % (grp,n))
-    for w in self.skip:
-      w2g.add(w, ',0')
+    def w2g_pairs():
+      for (word,(grp,n)) in word2grp.iteritems():
+        yield (word, '%s,%d' % (grp,n))
+      for w in self.skip:
+        yield (w, ',0')
+    cdbextend(w2g, w2g_pairs())
     w2g.finish()
     return
 
+  def write_dict(self, path, mph=False):
+    (grp2words, word2grp) = self._sort()
+    print >>sys.stderr, 'Writing: %r' % path
+    groups = sorted(grp2words.iterkeys())
+    gids = dict( (grp,gid) for (gid,grp) in enumerate(groups) )
+    entries = [ (w, gids[grp], n) for (w,(grp,n)) in word2grp.iteritems() ]
+    entries.extend( (w, DICT_NOGROUP, 0) for w in self.skip )
+    entries.sort()
+    seed = 0
+    if mph:
+      version = DICT_VERSION_MPH
+      keys = [ w for (w,_,_) in entries ]
+      # Try another seed if the hash cannot be made.
+      for seed in xrange(MPH_TRIES):
+        r = make_mph(keys, seed)
+        if r is not None: break
+      else:
+        raise ValueError('cannot make a perfect hash')
+      (slots, order) = r
+      ordered = [None]*len(entries)
+      for (e,i) in zip(entries, order):
+        ordered[i] = e
+      entries = ordered
+      nslots = len(slots)
+    else:
+      version = DICT_VERSION
+      nslots = len(entries)*4/3+1
+      slots = array('I', [0]*nslots*2)
+    slots_pos = struct.calcsize(DICT_HEADER)
+    if mph:
+      slots_pos += struct.calcsize(DICT_SEED)
+    words_pos = slots_pos + len(slots)*4
+    groups_pos = words_pos + len(entries)*16
+    data_pos = groups_pos + len(groups)*16
+    data = StringIO()
+    def put(s):
+      p = data_pos+data.tell()
+      data.write(s)
+      return p
+    words = array('I')
+    for (i,(w,gid,n)) in enumerate(entries):
+      words.extend((put(w), len(w), gid, n))
+      if mph: continue
+      h = dicthash(w)
+      j = h % nslots
+      while slots[j*2+1]:
+        j = (j+1) % nslots
+      slots[j*2] = h
+      slots[j*2+1] = i+1
+    grps = array('I')
+    for grp in groups:
+      ws = grp2words[grp]
+      p = put(grp)
+      index_pos = data_pos+data.tell()
+      put(get_index(ws, index_pos+(len(ws)+1)*4))
+      put(' '.join(ws))
+      grps.extend((p, len(grp), index_pos, len(ws)))
+    fp = file(path+'.tmp', 'wb')
+    fp.write(struct.pack(DICT_HEADER, DICT_MAGIC, version,
+                         len(entries), nslots, len(groups),
+                         slots_pos, words_pos, groups_pos))
+    if mph:
+      fp.write(struct.pack(DICT_SEED, seed))
+    fp.write(encode(slots))
+    fp.write(encode(words))
+    fp.write(encode(grps))
+    fp.write(data.getvalue())
+    fp.close()
+    os.rename(path+'.tmp', path)
+    return
+
+  # write_bloom: writes a Bloom filter for the dictionaries
+  #   with the given stamps.
+  def write_bloom(self, path, stamps):
+    (_, word2grp) = self._sort()
+    print >>sys.stderr, 'Writing: %r' % path
+    nkeys = len(word2grp)+len(self.skip)
+    bloom = BloomFilter(max(8, nkeys*BLOOM_BITS_PER_KEY), stamps=stamps)
+    for w in word2grp:
+      bloom.add(w)
+    for w in self.skip:
+      bloom.add(w)
+    fp = file(path+'.tmp', 'wb')
+    fp.write(bloom.tostring())
+    fp.close()
+    os.rename(path+'.tmp', path)
+    return
+
+  # write_hot: writes the nwords most frequent words and the skip list
+  #   with their groups resolved, for the dictionaries with the given stamps.
+  def write_hot(self, path, stamps, nwords=1000):
+    (grp2words, word2grp) = self._sort()
+    print >>sys.stderr, 'Writing: %r' % path
+    words = sorted(word2grp.iterkeys(),
+                   key=lambda w: (-self._words[w][0], w))[:nwords]
+    fp = file(path+'.tmp', 'wb')
+    fp.write('D %s\n' % ' '.join( str(x) for x in stamps ))
+    for grp in sorted(set( word2grp[w][0] for w in words )):
+      fp.write('G %s %s\n' % (grp, ' '.join(grp2words[grp])))
+    for w in words:
+      fp.write('W %s %s %d\n' % ((w,)+word2grp[w]))
+    for w in sorted(self.skip):
+      fp.write('S %s\n' % w)
+    fp.close()
+    os.rename(path+'.tmp', path)
+    return
+
 
 # main
 def main(argv):
   import getopt
   def usage():
-    print 'usage: %s [-O outdir] [-s skip] basedir' % argv[0]
+    print 'usage: %s [-O outdir] [-s skip] [-j nprocs] [-c cache] [-m] [-H nhot] basedir' % argv[0]
     return 100
   try:
-    (opts, args) = getopt.getopt(argv[1:], 'O:s:')
+    (opts, args) = getopt.getopt(argv[1:], 'O:s:j:c:mH:')
   except getopt.GetoptError:
     return usage()
   outdir = '.'
   skips = []
+  nprocs = 4
+  cachepath = None
+  mph = False
+  nhot = 1000
   for (k, v) in opts:
-    if k == '-O': output = v
+    if k == '-O': outdir = v
     elif k == '-s': skips.append(v)
+    elif k == '-j': nprocs = int(v)
+    elif k == '-c': cachepath = v
+    elif k == '-m': mph = True
+    elif k == '-H': nhot = int(v)
 
   if not args: return usage()
   basedir = args.pop(0)
@@ -298,13 +657,27 @@ def main(argv):
     fp = file(path, 'r')
     converter.read_skip(fp)
     fp.close()
-  converter.read('adj')
-  converter.read('adv')
-  converter.read('noun')
-  converter.read('verb')
-  g2wpath = os.path.join(outdir, 'g2w.cdb')
-  w2gpath = os.path.join(outdir, 'w2g.cdb')
-  converter.write(g2wpath, w2gpath)
+  if cachepath is None or not converter.load_cache(cachepath):
+    converter.read_all(('adj', 'adv', 'noun', 'verb'), nprocs=nprocs)
+  # All the files are built as *.new first and replaced together,
+  # so that a failure does not leave a mix of old and new files.
+  names = ('g2w.cdb', 'w2g.cdb', 'nlcrypt.dic', 'nlcrypt.blm', 'nlcrypt.hot')
+  paths = dict( (name, os.path.join(outdir, name)+'.new') for name in names )
+  try:
+    converter.write(paths['g2w.cdb'], paths['w2g.cdb'])
+    converter.write_dict(paths['nlcrypt.dic'], mph=mph)
+    stamps = dictstamps(paths['nlcrypt.dic'], paths['w2g.cdb'])
+    converter.write_bloom(paths['nlcrypt.blm'], stamps)
+    converter.write_hot(paths['nlcrypt.hot'], stamps, nhot)
+  except:
+    for path in paths.itervalues():
+      if os.path.exists(path):
+        os.remove(path)
+    raise
+  for name in names:
+    os.rename(paths[name], os.path.join(outdir, name))
+  if cachepath is not None:
+    converter.save_cache(cachepath)
   return
   
 if __name__ == '__main__': sys.exit(main(sys.argv))
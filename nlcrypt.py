@@ -7,50 +7,474 @@
 ##
 ##  Options:
 ##    -c codec          Specifies a Python codec (default: utf-8)
-##    -b basedir        Directory for dictionary files (w2g.cdb and g2w.cdb)
+##    -b basedir        Directory for dictionary files (nlcrypt.dic or w2g.cdb and g2w.cdb)
 ##    -R                Reverse the direction (decryption).
 ##    -C                Enables CBC mode.
+##    -j N              Runs N worker processes. Without CBC, the input is
+##                      split into chunks of lines. With CBC, each file is
+##                      processed separately with its own chain.
 ##
 import re
 import sys
 import hmac
+import hashlib
+import zlib
+import mmap
+import time
 import struct
 import os.path
+import threading
 import arcfour
+from array import array
+from collections import OrderedDict
 try:
     import cdb
+    CDB_OPTIONS = {}
 except ImportError:
     import pycdb as cdb
+    CDB_OPTIONS = {'usemmap': True}
 
 def adjust_caps(w1,w2):
     if w1[0].isupper() and w1[-1].isupper():
         # ALL CAPS.
         return w2.upper()
-    w = u''
-    for (i,c) in enumerate(w2):
-        if i < len(w1) and w1[i].isupper():
-            c = c.upper()
-        w += c
-    return w
-
-def segment_text(pat, s):
-    i0 = 0
-    for m in pat.finditer(s):
-        i1 = m.start(0)
-        if i0 < i1:
-            yield (False, s[i0:i1])
-        yield (True, m.group(0))
-        i0 = m.end(0)
-    if i0 < len(s):
-        yield (False, s[i0:])
-    return
+    if w1.islower():
+        # all lowercase.
+        return w2
+    n = len(w2)
+    if w1[0].isupper() and w1[1:n].islower():
+        # Capitalized.
+        return w2[:1].upper() + w2[1:]
+    return u''.join([ c.upper() if w1[i:i+1].isupper() else c
+                      for (i,c) in enumerate(w2) ])
 
 def is_voweled(w):
     w = w.lower()
     return (w[0] in 'aeiou')
 
+##  LRUCache
+##
+class LRUCache(object):
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        return
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, k):
+        with self._lock:
+            try:
+                item = self._items.pop(k)
+            except KeyError:
+                return None
+            (v, size, expires) = item
+            if expires is not None and expires < time.time():
+                self.size -= size
+                return None
+            self._items[k] = item
+            return v
+
+    def put(self, k, v, size=1):
+        expires = None
+        if self.ttl is not None:
+            expires = time.time()+self.ttl
+        with self._lock:
+            if k in self._items:
+                (_,size0,_) = self._items.pop(k)
+                self.size -= size0
+            self._items[k] = (v, size, expires)
+            self.size += size
+            while self.maxsize < self.size and self._items:
+                (_,(_,size1,_)) = self._items.popitem(last=False)
+                self.size -= size1
+        return
+
+
+##  WordGroup
+##
+##  Words of a group accessed through its offset index.
+##  The index is an array of uint32 offsets of every word
+##  in the space-joined group, followed by the total length.
+##
+class WordGroup(object):
+
+    def __init__(self, data, index):
+        a = array('I', index)
+        if sys.byteorder == 'big':
+            a.byteswap()
+        self._data = data
+        self._index = a
+        return
+
+    def __len__(self):
+        return len(self._index)-1
+
+    def __getitem__(self, i):
+        a = self._index
+        return self._data[a[i]:a[i+1]-1].decode('utf-8')
+
+
+##  CompactDictionary
+##
+##  A single-file dictionary (nlcrypt.dic) made by mkdict.py.
+##  All the integers are little-endian uint32.
+##
+##    header:  magic, version, nwords, nslots, ngroups,
+##             slots_pos, words_pos, groups_pos
+##    slots:   (hash, word+1) * nslots   (open addressing, 0 = empty)
+##    words:   (key_pos, key_len, group, index) * nwords
+##    groups:  (name_pos, name_len, index_pos, nwords) * ngroups
+##    data:    keys, group names, and for each group an offset index
+##             (nwords+1 entries) followed by its space-joined words.
+##
+##  Version 3 replaces the slots with a minimal perfect hash:
+##
+##    seed:    the seed of the hash (uint32, right after the header)
+##    slots:   displacement (int32) * nslots
+##    words:   ordered by the hash value, so that a word is
+##             found with one probe and one comparison.
+##
+##  (Version 2 had no seed and is not read any more.)
+##
+DICT_MAGIC = 'NLCD'
+DICT_VERSION = 1
+DICT_VERSION_MPH = 3
+DICT_HEADER = '<4s7I'
+DICT_SEED = '<I'
+DICT_NOGROUP = 0xffffffff
+
+def dicthash(k):
+    return zlib.crc32(k) & 0xffffffff
+
+# mphhash: returns (bucket, h1, h2) hashes of a key for the perfect hash.
+def mphhash(k, seed=0):
+    return struct.unpack_from('<III', hashlib.md5(struct.pack(DICT_SEED, seed)+k).digest())
+
+# mphslot: returns the slot of a key from the displacement of its bucket.
+def mphslot(d, h1, h2, n):
+    if d < 0:
+        return -d-1
+    return (h1+d*h2) % n
+
+class MappedWordGroup(WordGroup):
+
+    def __init__(self, data, pos, n):
+        self._data = data
+        self._pos = pos
+        self._n = n
+        return
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, i):
+        if not (0 <= i < self._n): raise IndexError(i)
+        (i0, i1) = struct.unpack_from('<II', self._data, self._pos+i*4)
+        return self._data[i0:i1-1].decode('utf-8')
+
+class CompactDictionary(object):
+
+    def __init__(self, path):
+        self._fp = open(path, 'rb')
+        self._map = m = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self._nwords, self._nslots, ngroups,
+         self._slots_pos, self._words_pos, groups_pos) = \
+            struct.unpack_from(DICT_HEADER, m, 0)
+        if magic != DICT_MAGIC or version not in (DICT_VERSION, DICT_VERSION_MPH):
+            raise ValueError('invalid dictionary: %r' % path)
+        if version == DICT_VERSION_MPH:
+            (self._seed,) = struct.unpack_from(DICT_SEED, m, struct.calcsize(DICT_HEADER))
+            self.word2group = self._word2group_mph
+        self._names = []
+        self._groups = {}
+        for gid in xrange(ngroups):
+            (p, n, index_pos, nwords) = struct.unpack_from('<4I', m, groups_pos+gid*16)
+            name = m[p:p+n]
+            self._names.append(name)
+            self._groups[name] = MappedWordGroup(m, index_pos, nwords)
+        return
+
+    def close(self):
+        self._map.close()
+        self._fp.close()
+        return
+
+    # word2group: returns (grp, index) of a word, or None if not found.
+    def word2group(self, w):
+        if isinstance(w, unicode):
+            w = w.encode('utf-8')
+        m = self._map
+        h = dicthash(w)
+        klen = len(w)
+        nslots = self._nslots
+        i = h % nslots
+        while 1:
+            (h1, x) = struct.unpack_from('<II', m, self._slots_pos+i*8)
+            if x == 0: return None
+            if h1 == h:
+                (p, n, gid, index) = struct.unpack_from(
+                    '<4I', m, self._words_pos+(x-1)*16)
+                # compare the key in place.
+                if n == klen and m.find(w, p, p+n) == p:
+                    if gid == DICT_NOGROUP:
+                        return ('', 0)
+                    return (self._names[gid], index)
+            i = (i+1) % nslots
+
+    def _word2group_mph(self, w):
+        if isinstance(w, unicode):
+            w = w.encode('utf-8')
+        if self._nwords == 0: return None
+        m = self._map
+        (h0, h1, h2) = mphhash(w, self._seed)
+        (d,) = struct.unpack_from('<i', m, self._slots_pos+(h0 % self._nslots)*4)
+        i = mphslot(d, h1, h2, self._nwords)
+        (p, n, gid, index) = struct.unpack_from('<4I', m, self._words_pos+i*16)
+        if n == len(w) and m.find(w, p, p+n) == p:
+            if gid == DICT_NOGROUP:
+                return ('', 0)
+            return (self._names[gid], index)
+        return None
+
+    def group2words(self, grp):
+        return self._groups[grp]
+
+    def itergroups(self):
+        return self._groups.iteritems()
+
+
+# dictstamps: returns the stamps (size, crc) of nlcrypt.dic and w2g.cdb
+#   that tell the files made with them (nlcrypt.blm and nlcrypt.hot)
+#   whether they are still current. A missing file has (0, 0).
+NOSTAMPS = (0, 0, 0, 0)
+def dictstamps(dicpath, w2gpath):
+    stamps = []
+    for path in (dicpath, w2gpath):
+        (size, crc) = (0, 0)
+        if path is not None and os.path.exists(path):
+            fp = open(path, 'rb')
+            while 1:
+                data = fp.read(1024*1024)
+                if not data: break
+                size += len(data)
+                crc = zlib.crc32(data, crc)
+            fp.close()
+        stamps.extend((size, crc & 0xffffffff))
+    return tuple(stamps)
+
+
+##  BloomFilter
+##
+##  A set of the dictionary keys (nlcrypt.blm) made by mkdict.py
+##  that rejects most of the unknown words without a lookup.
+##
+##    header:  magic, version, nbits, nhashes, stamps
+##    bits:    (nbits+7)/8 bytes
+##
+##  stamps are the stamps (size, crc) of nlcrypt.dic and w2g.cdb
+##  it was made with. It is not used with any other dictionary.
+##
+BLOOM_MAGIC = 'NLCB'
+BLOOM_VERSION = 2
+BLOOM_HEADER = '<4s7I'
+BLOOM_BITS_PER_KEY = 10
+BLOOM_HASHES = 7
+
+class BloomFilter(object):
+
+    def __init__(self, nbits, nhashes=BLOOM_HASHES, bits=None, stamps=NOSTAMPS):
+        if bits is None:
+            bits = (nbits+7)/8
+        self.nbits = nbits
+        self.nhashes = nhashes
+        self.stamps = stamps
+        self._bits = bytearray(bits)
+        return
+
+    @classmethod
+    def load(klass, path):
+        fp = open(path, 'rb')
+        data = fp.read()
+        fp.close()
+        size = struct.calcsize(BLOOM_HEADER)
+        if len(data) < size:
+            raise ValueError('invalid bloom filter: %r' % path)
+        header = struct.unpack_from(BLOOM_HEADER, data, 0)
+        (magic, version, nbits, nhashes) = header[:4]
+        if magic != BLOOM_MAGIC or version != BLOOM_VERSION:
+            raise ValueError('invalid bloom filter: %r' % path)
+        stamps = header[4:]
+        return klass(nbits, nhashes, data[size:], stamps)
+
+    def _hashes(self, k):
+        if isinstance(k, unicode):
+            k = k.encode('utf-8')
+        (h1, h2) = struct.unpack_from('<II', hashlib.md5(k).digest())
+        h2 |= 1
+        nbits = self.nbits
+        for i in xrange(self.nhashes):
+            yield (h1+i*h2) % nbits
+        return
+
+    def add(self, k):
+        bits = self._bits
+        for i in self._hashes(k):
+            bits[i>>3] |= 1 << (i&7)
+        return
+
+    def __contains__(self, k):
+        bits = self._bits
+        for i in self._hashes(k):
+            if not (bits[i>>3] & (1 << (i&7))):
+                return False
+        return True
+
+    def tostring(self):
+        return (struct.pack(BLOOM_HEADER, BLOOM_MAGIC, BLOOM_VERSION,
+                            self.nbits, self.nhashes, *self.stamps) +
+                str(self._bits))
+
+
+##  Dictionary
+##
+##  Read-only dictionary loaded once and shared by
+##  all the NLCrypt sessions (and threads) in a process.
+##
+class Dictionary(object):
+
+    # Maximum number of the resolved words kept in the memo.
+    # Word frequencies follow Zipf's law, so a small memo
+    # catches most of the words.
+    MEMO_SIZE = 4096
+
+    # Memory budget (in bytes of raw group data) of the group cache.
+    GROUP_CACHE_SIZE = 8*1024*1024
+
+    def __init__(self, basedir='.'):
+        self.basedir = basedir
+        # memo: resolved words shared by the NLCrypt sessions
+        # (up to MEMO_SIZE words).
+        self.memo = {}
+        path = os.path.join(basedir, 'nlcrypt.dic')
+        if os.path.exists(path):
+            self._dict = CompactDictionary(path)
+            self._stamppaths = (path, None)
+        else:
+            self._dict = None
+            path = os.path.join(basedir, 'w2g.cdb')
+            self._word2group = cdb.init(path, **CDB_OPTIONS)
+            self._group2words = cdb.init(os.path.join(basedir, 'g2w.cdb'), **CDB_OPTIONS)
+            self._group_cache = LRUCache(self.GROUP_CACHE_SIZE)
+            self._stamppaths = (None, path)
+        self._stamps = None
+        self._bloom = None
+        path = os.path.join(basedir, 'nlcrypt.blm')
+        if os.path.exists(path):
+            try:
+                bloom = BloomFilter.load(path)
+            except ValueError:
+                bloom = None
+            # A filter made for another dictionary would reject its words.
+            if bloom is not None and self._is_current(bloom.stamps):
+                self._bloom = bloom
+        self._hot = {}
+        self._hot_groups = {}
+        path = os.path.join(basedir, 'nlcrypt.hot')
+        if os.path.exists(path):
+            self._load_hot(path)
+        return
+
+    # _is_current: tells whether a file made with the given stamps
+    #   belongs to the dictionary file that is actually used.
+    def _is_current(self, stamps):
+        if self._stamps is None:
+            self._stamps = dictstamps(*self._stamppaths)
+        if self._dict is not None:
+            return (stamps[:2] == self._stamps[:2])
+        return (stamps[2:] == self._stamps[2:])
+
+    def _load_hot(self, path):
+        # nlcrypt.hot: the most frequent words made by mkdict.py.
+        #   D stamps ...     (the stamps of the dictionary, first line)
+        #   G grp word ...   (the words of a group)
+        #   W word grp index
+        #   S word           (a skip word)
+        #   The table is ignored unless it was made with this dictionary.
+        fp = open(path, 'rb')
+        try:
+            f = fp.readline().split()
+            if f[:1] != ['D'] or not self._is_current(tuple(map(int, f[1:]))):
+                return
+            for line in fp:
+                f = line.decode('utf-8').split()
+                if f[0] == 'G':
+                    self._hot_groups[f[1].encode('utf-8')] = f[2:]
+                elif f[0] == 'W':
+                    self._hot[f[1]] = (f[2].encode('utf-8'), int(f[3]))
+                elif f[0] == 'S':
+                    self._hot[f[1]] = ('', 0)
+        finally:
+            fp.close()
+        return
+
+    _loaded = {}
+    _lock = threading.Lock()
+    # load: returns the dictionary in basedir, opening it once per process.
+    @classmethod
+    def load(klass, basedir='.'):
+        path = os.path.abspath(basedir)
+        with klass._lock:
+            if path not in klass._loaded:
+                klass._loaded[path] = klass(path)
+            return klass._loaded[path]
+
+    # word2group: returns (grp, index) of a word, or None if not found.
+    def word2group(self, w):
+        r = self._hot.get(w)
+        if r is not None:
+            return r
+        if self._bloom is not None and w not in self._bloom:
+            return None
+        if self._dict is not None:
+            return self._dict.word2group(w)
+        v = self._word2group.get(w)
+        if v is None: return None
+        (grp,_,n) = v.partition(',')
+        return (grp, int(n))
+
+    def group2words(self, grp):
+        words = self._hot_groups.get(grp)
+        if words is not None:
+            return words
+        if self._dict is not None:
+            return self._dict.group2words(grp)
+        words = self._group_cache.get(grp)
+        if words is None:
+            data = self._group2words[grp]
+            index = self._group2words.get('#'+grp)
+            if index is None:
+                # Old dictionaries have no index.
+                words = data.decode('utf-8').split(' ')
+                self._group_cache.put(grp, words, len(data))
+            else:
+                words = WordGroup(data, index)
+                self._group_cache.put(grp, words, len(data)+len(index))
+        return words
+
+
+##  NLCrypt
+##
+##  A cipher session for one message. Sessions are cheap to create
+##  and are not shared between threads; the dictionary is.
+##
 class NLCrypt(object):
-    
+
     GROUP2CHARS = (
         u'0123456789',
         u'aeiou',
@@ -63,25 +487,54 @@ class NLCrypt(object):
         for (n,c) in enumerate(chars):
             CHAR2GROUP[c] = (grp,n)
 
-    def __init__(self, key, reverse=False, cbc=False, basedir='.', debug=0):
+    def __init__(self, key, reverse=False, cbc=False, basedir='.', debug=0,
+                 offsets=None, dictionary=None):
+        # offsets: a table of ECB offsets that can be shared
+        # between the instances with the same key.
+        # dictionary: a Dictionary object (loaded from basedir if not given).
+        self._key = key
         self._hmac = hmac.HMAC(key) # Defaults to MD5.
         self.reverse = reverse
         self.cbc = cbc
         self.debug = debug
-        self.WORD2GROUP = cdb.init(os.path.join(basedir, 'w2g.cdb'))
-        self.GROUP2WORDS = cdb.init(os.path.join(basedir, 'g2w.cdb'))
+        if dictionary is None:
+            dictionary = Dictionary.load(basedir)
+        self.dictionary = dictionary
         self._a0 = None
         self._a1 = None
+        if offsets is None:
+            offsets = {}
+        self._offsets = offsets
         return
 
-    def _crypt(self, i0, grp, n):
-        assert i0 < n
+    # reset: starts a new message with the same key.
+    def reset(self):
+        self._hmac = hmac.HMAC(self._key)
+        self._a0 = None
+        self._a1 = None
+        return
+
+    def _offset(self, grp, n):
         k = self._hmac.digest()+grp
         v = struct.pack('=I', n)
         v = arcfour.Arcfour(k).process(v)
         if self.cbc:
             self._hmac.update(v)
         (x,) = struct.unpack('=I', v[:4])
+        return x
+
+    def _crypt(self, i0, grp, n):
+        assert i0 < n
+        if self.cbc:
+            x = self._offset(grp, n)
+        else:
+            # Without CBC, the HMAC never changes and
+            # each (grp,n) always gets the same offset.
+            try:
+                x = self._offsets[(grp,n)]
+            except KeyError:
+                x = self._offset(grp, n)
+                self._offsets[(grp,n)] = x
         if self.reverse:
             i1 = (i0-x) % n
         else:
@@ -99,28 +552,39 @@ class NLCrypt(object):
         return c1
 
     def _word2group(self, w):
-        (grp,_,n) = self.WORD2GROUP[w].partition(',')
-        return (grp, int(n))
+        return self.dictionary.word2group(w)
     
-    _group2words_cache = {}
     def _group2words(self, grp):
-        if grp in self._group2words_cache:
-            words = self._group2words_cache
-        else:
-            words = self.GROUP2WORDS[grp].decode('utf-8').split(' ')
-            self._group2words_cache = words
-        return words
+        return self.dictionary.group2words(grp)
 
     IGNORE = re.compile(r'^(\w\W)+$', re.U)
+
+    # _resolve: returns (grp, index) of a normalized word, or None if unknown.
+    #   Ignored words have an empty group. Unknown words (names, numbers,
+    #   etc.) are not kept in the memo; they are mostly seen only once
+    #   and the Bloom filter makes them cheap anyway.
+    def _resolve(self, k):
+        memo = self.dictionary.memo
+        try:
+            return memo[k]
+        except KeyError:
+            pass
+        if self.IGNORE.match(k):
+            r = ('', 0)
+        else:
+            r = self._word2group(k)
+        if r is not None:
+            if self.dictionary.MEMO_SIZE <= len(memo):
+                memo.clear()
+            memo[k] = r
+        return r
     
     def crypt_word(self, w0, force=False):
         w1 = None
         k = w0.lower().replace(u'\u2019',u",")
-        if self.IGNORE.match(k):
-            w1 = w0
-            self._debug_ignore(w0)
-        elif k in self.WORD2GROUP:
-            (grp,i0) = self._word2group(k)
+        r = self._resolve(k)
+        if r is not None:
+            (grp,i0) = r
             if grp:
                 words = self._group2words(grp)
                 i1 = self._crypt(i0, grp, len(words))
@@ -137,36 +601,64 @@ class NLCrypt(object):
 
     WORD = re.compile(ur'[-\u2019\'\-\.\w]+', re.U)
     PART = re.compile(ur'\d+|\w+|\'\w+', re.U)
+    # TOKEN splits a text into the PARTs, the non-PART characters
+    # within a WORD and the separators between WORDs at once.
+    # (WORD and PART are still used to find the last word of a chunk.)
+    TOKEN = re.compile(ur'(\d+|\w+|\'\w+)|((?:[-\u2019\.]|\'(?!\w))+)|([^-\u2019\'\.\w]+)', re.U)
+
+    # _tokenize: yields (i, j, parts) for each word or separator in s.
+    #   parts is None for a separator, or the list of (ispart, i, j)
+    #   spans in a word.
+    def _tokenize(self, s):
+        (i0, j0) = (0, 0)
+        parts = []
+        for m in self.TOKEN.finditer(s):
+            (i, j) = m.span()
+            if m.lastindex == 3:
+                if parts:
+                    yield (i0, j0, parts)
+                    parts = []
+                yield (i, j, None)
+            else:
+                if not parts:
+                    i0 = i
+                parts.append((m.lastindex == 1, i, j))
+                j0 = j
+        if parts:
+            yield (i0, j0, parts)
+        return
 
     def _handle_a(self, w):
         if self._a0 is None and w.lower() in ('a', 'an'):
             self._a0 = w
-            self._a1 = u''
+            self._a1 = []
             return True
         return False
         
     def _put_space(self, s):
         if self._a0 is not None:
-            self._a1 += s
+            self._a1.append(s)
         else:
-            self._output += s
+            self._output.append(s)
         return
         
     def _put_word(self, w):
         if self._a0 is not None:
-            a = 'a'
+            a = u'a'
             if is_voweled(w):
-                a = 'an'
-            self._output += adjust_caps(self._a0, a)
-            self._output += self._a1
+                a = u'an'
+            self._output.append(adjust_caps(self._a0, a))
+            self._output.extend(self._a1)
             self._a0 = None
-        self._output += w
+        self._output.append(w)
         return
 
     def feed(self, s):
-        self._output = u''
-        for (isword,w0) in segment_text(self.WORD, s):
-            if not isword:
+        # The output is collected in a list and joined at the end.
+        self._output = []
+        for (i,j,parts) in self._tokenize(s):
+            w0 = s[i:j]
+            if parts is None:
                 self._put_space(w0)
                 continue
             if self._handle_a(w0):
@@ -175,13 +667,46 @@ class NLCrypt(object):
             if w1 is not None:
                 self._put_word(w1)
                 continue
-            for (ispart,p0) in segment_text(self.PART, w0):
+            for (ispart,i,j) in parts:
+                p0 = s[i:j]
                 if not ispart:
                     self._put_space(p0)
                     continue
                 p1 = self.crypt_word(p0, force=True)
                 self._put_word(p1 or p0)
-        return self._output
+        return u''.join(self._output)
+
+    # flush: returns the pending output (an article without its following word).
+    def flush(self):
+        output = u''
+        if self._a0 is not None:
+            output = self._a0 + u''.join(self._a1)
+            self._a0 = None
+            self._a1 = None
+        return output
+
+    # iterfeed: encrypts/decrypts an iterable of text chunks incrementally.
+    #   Yields each piece of the output as soon as it is final.
+    #   A word that reaches the end of a chunk is held back until
+    #   the next chunk tells whether it continues.
+    def iterfeed(self, chunks):
+        buf = u''
+        for s in chunks:
+            buf += s
+            i = len(buf)
+            m = None
+            for m in self.WORD.finditer(buf):
+                pass
+            if m is not None and m.end(0) == i:
+                i = m.start(0)
+            output = self.feed(buf[:i])
+            buf = buf[i:]
+            if output:
+                yield output
+        output = self.feed(buf) + self.flush()
+        if output:
+            yield output
+        return
 
     def _debug_ignore(self, w):
         if self.debug:
@@ -196,14 +721,84 @@ class NLCrypt(object):
             print 'unknown: %s -> %s' % (w0,w1)
         return
 
+##  Parallel processing
+##
+CHUNK_SIZE = 256*1024
+
+# iterchunks: groups lines into chunks that can be processed independently.
+def iterchunks(lines, codec, size=CHUNK_SIZE):
+    def is_pending(buf):
+        # A chunk cannot end with an article waiting for its following word.
+        # A WORD without any PART (e.g. '--') is a separator for feed().
+        for line in reversed(buf):
+            words = NLCrypt.WORD.findall(line.decode(codec, 'ignore'))
+            for w in reversed(words):
+                if NLCrypt.PART.search(w):
+                    return w.lower() in ('a', 'an')
+        return False
+    buf = []
+    n = 0
+    for line in lines:
+        buf.append(line)
+        n += len(line)
+        if size <= n and not is_pending(buf):
+            yield ''.join(buf)
+            buf = []
+            n = 0
+    if buf:
+        yield ''.join(buf)
+    return
+
+_worker = None
+def _init_worker(key, reverse, cbc, basedir, codec):
+    global _worker
+    _worker = (NLCrypt(key, reverse=reverse, cbc=cbc, dictionary=Dictionary.load(basedir)), codec)
+    return
+
+def _crypt_chunk(data):
+    (nlcrypt, codec) = _worker
+    lines = ( line.decode(codec, 'ignore') for line in data.splitlines(True) )
+    return ''.join( text.encode(codec, 'ignore') for text in nlcrypt.iterfeed(lines) )
+
+def _crypt_file((path, data)):
+    (nlcrypt, _) = _worker
+    nlcrypt.reset()
+    if data is None:
+        fp = file(path, 'rb')
+        data = fp.read()
+        fp.close()
+    return _crypt_chunk(data)
+
+def run_parallel(nworkers, key, args, reverse=False, cbc=False, basedir='.', codec='utf-8'):
+    import fileinput
+    from multiprocessing import Pool
+    pool = Pool(nworkers, _init_worker, (key, reverse, cbc, basedir, codec))
+    try:
+        if cbc:
+            # Only the files are independent.
+            tasks = [ (path, sys.stdin.read() if path == '-' else None) for path in args ]
+            results = pool.imap(_crypt_file, tasks)
+        else:
+            chunks = iterchunks(fileinput.input(args), codec)
+            results = pool.imap(_crypt_chunk, chunks)
+        for data in results:
+            sys.stdout.write(data)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return
+
 def main(argv):
     import getopt
     import fileinput
     def usage():
-        print 'usage: %s [-d] [-c codec] [-b basedir] [-C] [-R] key [file ...]' % argv[0]
+        print 'usage: %s [-d] [-c codec] [-b basedir] [-C] [-R] [-j N] key [file ...]' % argv[0]
         return 100
     try:
-        (opts, args) = getopt.getopt(argv[1:], 'dc:b:CR')
+        (opts, args) = getopt.getopt(argv[1:], 'dc:b:CRj:')
     except getopt.GetoptError:
         return usage()
     debug = 0
@@ -211,19 +806,24 @@ def main(argv):
     basedir = '.'
     cbc = False
     reverse = False
+    nworkers = 0
     for (k, v) in opts:
         if k == '-d': debug += 1
         elif k == '-c': codec = v
         elif k == '-b': basedir = v
         elif k == '-C': cbc = True
         elif k == '-R': reverse = True
+        elif k == '-j': nworkers = int(v)
     if not args: return usage()
     #
     key = args.pop(0)
+    if 1 < nworkers and (args or not cbc):
+        run_parallel(nworkers, key, args, reverse=reverse, cbc=cbc,
+                     basedir=basedir, codec=codec)
+        return 0
     nlcrypt = NLCrypt(key, reverse=reverse, cbc=cbc, basedir=basedir, debug=debug)
-    for line in fileinput.input(args):
-        text = line.decode(codec, 'ignore')
-        text = nlcrypt.feed(text)
+    lines = ( line.decode(codec, 'ignore') for line in fileinput.input(args) )
+    for text in nlcrypt.iterfeed(lines):
         sys.stdout.write(text.encode(codec, 'ignore'))
     return 0
 
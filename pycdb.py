@@ -7,13 +7,18 @@
 # 
 
 import sys, os
-from struct import pack, unpack
+import mmap
+import heapq
+from struct import pack, unpack, unpack_from
 from array import array
 
 
 # calc hash value with a given key
-def cdbhash(s, n=0L):
-  return reduce(lambda h,c: ((h*33) ^ ord(c)) & 0xffffffffL, s, n+5381L)
+def cdbhash(s, n=0):
+  h = n+5381
+  for c in bytearray(s):
+    h = ((h*33) ^ c) & 0xffffffff
+  return h
 
 if pack('=i',1) == pack('>i',1):
   # big endian
@@ -36,28 +41,44 @@ else:
 ##  CDB
 ##
 
-# cdbiter
-def cdbiter(fp, eod=0):
+# cdbiter: reads the records sequentially through a buffer.
+def cdbiter(fp, eod=0, bufsize=65536):
   kloc = 2048
+  fp.seek(kloc)
+  buf = ''
+  i = 0
   while eod == 0 or kloc < eod:
-    fp.seek(kloc)
-    x = fp.read(8)
-    if len(x) != 8: break
-    (klen, vlen) = unpack('<II', x)
-    k = fp.read(klen)
-    v = fp.read(vlen)
-    kloc += 8+klen+vlen
+    if len(buf)-i < 8:
+      buf = buf[i:]+fp.read(bufsize)
+      i = 0
+      if len(buf) < 8: break
+    (klen, vlen) = unpack_from('<II', buf, i)
+    n = 8+klen+vlen
+    if len(buf)-i < n:
+      buf = buf[i:]+fp.read(max(bufsize, n))
+      i = 0
+      if len(buf) < n: break
+    i += 8
+    k = buf[i:i+klen]
+    i += klen
+    v = buf[i:i+vlen]
+    i += vlen
+    kloc += n
     yield (k,v)
   fp.close()
   return
 
 
 # CDBReader
+#   Records are read through a read-only mmap, so threads can share
+#   a reader without a lock around every lookup.
 class CDBReader(object):
   
   def __init__(self, cdbname, docache=False):
+    self.name = cdbname
     self._fp = file(cdbname, 'rb')
-    hash0 = decode(self._fp.read(2048))
+    self._map = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+    hash0 = decode(self._map[:2048])
     self._hash0 = [ (hash0[i], hash0[i+1]) for i in xrange(0, 512, 2) ]
     self._hash1 = [ None ] * 256
     (self._eod,_) = self._hash0[0]
@@ -79,6 +100,9 @@ class CDBReader(object):
   def __iter__(self):
     return self.iterkeys()
 
+  def _read(self, pos, n):
+    return self._map[pos:pos+n]
+
   def __getitem__(self, k):
     k = str(k)
     if k in self._cache: return self._cache[k]
@@ -88,20 +112,21 @@ class CDBReader(object):
     if ncells == 0: raise KeyError(k)
     hs = self._hash1[h1]
     if hs == None:
-      self._fp.seek(pos_bucket)
-      hs = decode(self._fp.read(ncells * 8))
+      # Threads may fill the same bucket, with the same value.
+      hs = decode(self._read(pos_bucket, ncells * 8))
       self._hash1[h1] = hs
     i = ((h >> 8) % ncells) * 2
     n = ncells*2
+    klen = len(k)
     for _ in xrange(ncells):
       p1 = hs[i+1]
       if p1 == 0: raise KeyError(k)
       if hs[i] == h:
-        self._fp.seek(p1)
-        (klen, vlen) = unpack('<II', self._fp.read(8))
-        k1 = self._fp.read(klen)
-        if k1 == k:
-          v1 = self._fp.read(vlen)
+        # read the header and the key at once.
+        x = self._read(p1, 8+klen)
+        (klen1, vlen) = unpack('<II', x[:8])
+        if klen1 == klen and x[8:] == k:
+          v1 = self._read(p1+8+klen, vlen)
           if self._docache:
             self._cache[k] = v1
           return v1
@@ -125,9 +150,13 @@ class CDBReader(object):
     self._keyiter = None
     return self.nextkey()
   
+  def _iter(self):
+    # Iterators have their own file object.
+    return cdbiter(file(self.name, 'rb'), self._eod)
+
   def nextkey(self):
     if not self._keyiter:
-      self._keyiter = ( k for (k,v) in cdbiter(self._fp, self._eod) )
+      self._keyiter = ( k for (k,v) in self._iter() )
     try:
       return self._keyiter.next()
     except StopIteration:
@@ -135,18 +164,49 @@ class CDBReader(object):
 
   def each(self):
     if not self._eachiter:
-      self._eachiter = cdbiter(self._fp, self._eod)
+      self._eachiter = self._iter()
     try:
       return self._eachiter.next()
     except StopIteration:
       return None
 
   def iterkeys(self):
-    return ( k for (k,v) in cdbiter(self._fp, self._eod) )
+    return ( k for (k,v) in self._iter() )
   def itervalues(self):
-    return ( v for (k,v) in cdbiter(self._fp, self._eod) )
+    return ( v for (k,v) in self._iter() )
   def iteritems(self):
-    return cdbiter(self._fp, self._eod)
+    return self._iter()
+
+
+# CDBMmapReader
+#   Reads the hash tables and compares the keys in the mmap
+#   without copying them.
+class CDBMmapReader(CDBReader):
+
+  def __getitem__(self, k):
+    k = str(k)
+    if k in self._cache: return self._cache[k]
+    m = self._map
+    h = cdbhash(k)
+    (pos_bucket, ncells) = self._hash0[h & 0xff]
+    if ncells == 0: raise KeyError(k)
+    klen = len(k)
+    i = (h >> 8) % ncells
+    for _ in xrange(ncells):
+      (h1, p1) = unpack_from('<II', m, pos_bucket+i*8)
+      if p1 == 0: raise KeyError(k)
+      if h1 == h:
+        (klen1, vlen) = unpack_from('<II', m, p1)
+        p1 += 8
+        # compare the key in place.
+        if klen1 == klen and m.find(k, p1, p1+klen) == p1:
+          p1 += klen
+          v1 = m[p1:p1+vlen]
+          if self._docache:
+            self._cache[k] = v1
+          return v1
+      i = (i+1) % ncells
+    raise KeyError(k)
 
 
 # CDBMaker
@@ -188,6 +248,44 @@ class CDBMaker(object):
     self._addkey(k, 8+klen+vlen)
     return self
 
+  # extend: adds (key, value) pairs, writing them through a large buffer.
+  def extend(self, pairs, bufsize=1024*1024):
+    fp = self._fp
+    fp.seek(self._pos)
+    buckets = self._bucket
+    pos = self._pos
+    size = self._size
+    n = 0
+    buf = []
+    nbuf = 0
+    for (k, v) in pairs:
+      (k, v) = (str(k), str(v))
+      (klen, vlen) = (len(k), len(v))
+      buf.append(pack('<II', klen, vlen))
+      buf.append(k)
+      buf.append(v)
+      h = 5381
+      for c in bytearray(k):
+        h = ((h*33) ^ c) & 0xffffffff
+      b = buckets[h % 256]
+      b.append(h)
+      b.append(pos)
+      rlen = 8+klen+vlen
+      pos += rlen
+      size += rlen+16
+      n += 1
+      nbuf += rlen
+      if bufsize <= nbuf:
+        fp.write(''.join(buf))
+        buf = []
+        nbuf = 0
+    if buf:
+      fp.write(''.join(buf))
+    self._pos = pos
+    self._size = size
+    self.numentries += n
+    return self
+
   def _addkey(self, k, size):
     h = cdbhash(k)
     b = self._bucket[h % 256]
@@ -217,15 +315,16 @@ class CDBMaker(object):
     for b1 in self._bucket:
       if not b1: continue
       blen = len(b1)
-      a = array('I', [0]*blen*2)
+      alen = blen*2
+      a = [0]*alen
       for j in xrange(0, blen, 2):
-        (h,p) = (b1[j],b1[j+1])
+        h = b1[j]
         i = ((h >> 8) % blen)*2
         while a[i+1]:             # is cell[i] already occupied?
-          i = (i+2) % len(a)
+          i = (i+2) % alen
         a[i] = h
-        a[i+1] = p
-      self._fp.write(encode(a))
+        a[i+1] = b1[j+1]
+      self._fp.write(encode(array('I', a)))
     assert self._fp.tell() == self._size
     # write header
     self._fp.seek(0)
@@ -241,21 +340,52 @@ class CDBMaker(object):
     return
 
   # txt2cdb
-  def txt2cdb(self, lines):
+  #   Parses "+klen,vlen:key->value\n" records from a stream of strings
+  #   (e.g. lines). Keys and values are read by their lengths, so they
+  #   can contain newlines. An empty line ends the input.
+  def _txt2pairs(self, lines):
     import re
     HEAD = re.compile(r'^\+(\d+),(\d+):')
-    for line in lines:
-      m = HEAD.match(line)
-      if not m: break
+    lines = iter(lines)
+    buf = ['', 0]
+    def fill(n):
+      # Makes sure that n bytes are buffered.
+      (s, i) = buf
+      if len(s)-i < n:
+        s = s[i:]
+        i = 0
+        for line in lines:
+          s += line
+          if n <= len(s): break
+        buf[:] = [s, i]
+      return n <= len(s)-i
+    while fill(1):
+      (s, i) = buf
+      if s[i] == '\n': return
+      j = s.find(':', i)
+      while j < 0 and len(s)-i < 32 and fill(len(s)-i+1):
+        (s, i) = buf
+        j = s.find(':', i)
+      m = HEAD.match(s[i:j+1]) if 0 <= j else None
+      if not m: raise ValueError('invalid record: %r' % s[i:i+32])
       (klen, vlen) = (int(m.group(1)), int(m.group(2)))
-      i = len(m.group(0))
-      k = line[i:i+klen]
+      n = len(m.group(0))+klen+2+vlen+1
+      if not fill(n): raise ValueError('truncated record: %r' % s[i:i+32])
+      (s, i) = buf
+      i += len(m.group(0))
+      k = s[i:i+klen]
       i += klen
-      if line[i:i+2] != '->': raise ValueError('invalid separator: %r' % line)
+      if s[i:i+2] != '->': raise ValueError('invalid separator: %r' % s[i:i+2])
       i += 2
-      v = line[i:i+vlen]
-      self.add(k, v)
-    return self
+      v = s[i:i+vlen]
+      i += vlen
+      if s[i] != '\n': raise ValueError('invalid record end: %r' % s[i])
+      buf[1] = i+1
+      yield (k, v)
+    return
+
+  def txt2cdb(self, lines):
+    return self.extend(self._txt2pairs(lines))
 
 
 # cdbdump
@@ -265,32 +395,116 @@ def cdbdump(cdbname):
   return cdbiter(fp, eor)
 
 
-# cdbmerge
+# cdb2txt
+def cdb2txt(items):
+  for (k,v) in items:
+    yield '+%d,%d:%s->%s\n' % (len(k), len(v), k, v)
+  yield '\n'
+  return
+
+
+# cdbmerge: k-way merge of iterators sorted by key.
 def cdbmerge(iters):
   q = []
-  for it in iters:
+  for (i,it) in enumerate(iters):
     try:
-      q.append((it.next(),it))
+      q.append((it.next(),i,it))
     except StopIteration:
       pass
+  heapq.heapify(q)
   k0 = None
   vs = None
   while q:
-    q.sort()
-    ((k,v),it) = q.pop(0)
+    ((k,v),i,it) = q[0]
     if k0 != k:
       if vs: yield (k0,vs)
       vs = []
     vs.append(v)
     k0 = k
     try:
-      q.append((it.next(),it))
+      heapq.heapreplace(q, (it.next(),i,it))
     except StopIteration:
-      continue
+      heapq.heappop(q)
   if vs: yield (k0,vs)
   return
 
 
+# cdbsort: sorts (k,v) pairs with a bounded memory.
+#   Sorted runs of runsize pairs are spilled to temporary files
+#   (in the cdb record format) and merged.
+def cdbsort(pairs, runsize=100000):
+  import tempfile
+  runs = []
+  buf = []
+  def spill():
+    buf.sort()
+    fp = tempfile.TemporaryFile()
+    fp.write('\0'*2048)
+    for (k,v) in buf:
+      fp.write(pack('<II', len(k), len(v)))
+      fp.write(k)
+      fp.write(v)
+    runs.append(fp)
+    del buf[:]
+    return
+  for (k,v) in pairs:
+    buf.append((k,v))
+    if runsize <= len(buf):
+      spill()
+  if not runs:
+    buf.sort()
+    return iter(buf)
+  if buf:
+    spill()
+  return heapq.merge(*[ cdbiter(fp) for fp in runs ])
+
+
+# init
+def init(cdbname, docache=False, usemmap=False):
+  if usemmap:
+    return CDBMmapReader(cdbname, docache=docache)
+  return CDBReader(cdbname, docache=docache)
+
+
 # aliases
 cdbmake = CDBMaker
-init = CDBReader
+
+
+# main
+def main(argv):
+  import getopt
+  def usage():
+    print ('usage: %s dump in.cdb\n'
+           '       %s make out.cdb [in.txt ...]\n'
+           '       %s merge out.cdb in.cdb ...\n'
+           '       %s rebuild in.cdb out.cdb' % ((argv[0],)*4))
+    return 100
+  try:
+    (opts, args) = getopt.getopt(argv[1:], '')
+  except getopt.GetoptError:
+    return usage()
+  if not args: return usage()
+  cmd = args.pop(0)
+  if cmd == 'dump' and len(args) == 1:
+    for line in cdb2txt(cdbdump(args[0])):
+      sys.stdout.write(line)
+  elif cmd == 'make' and args:
+    import fileinput
+    maker = CDBMaker(args.pop(0))
+    maker.txt2cdb(fileinput.input(args))
+    maker.finish()
+  elif cmd == 'merge' and 2 <= len(args):
+    # The records of each input are sorted (on disk if needed) before merging.
+    maker = CDBMaker(args.pop(0))
+    iters = [ cdbsort(cdbdump(path)) for path in args ]
+    maker.extend( (k,v) for (k,vs) in cdbmerge(iters) for v in vs )
+    maker.finish()
+  elif cmd == 'rebuild' and len(args) == 2:
+    maker = CDBMaker(args[1])
+    maker.extend(cdbdump(args[0]))
+    maker.finish()
+  else:
+    return usage()
+  return 0
+
+if __name__ == '__main__': sys.exit(main(sys.argv))